@@ -1,13 +1,23 @@
 from flask import Flask, render_template, request, redirect, flash, url_for, abort
 import os
-import yaml
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 import csv
+import json
+import hashlib
+import tempfile
+import re
+import functools
+import hmac
+import http.cookiejar
 from pathlib import Path
 from dotenv import load_dotenv
-from collections import defaultdict
 import time
+import threading
+import queue
+import atexit
+from collections import OrderedDict
 
 load_dotenv()
 
@@ -15,38 +25,89 @@ load_dotenv()
 app = Flask(__name__, template_folder='templates')
 app.secret_key = os.getenv("FLASK_SECRET", "supersecretkey")
 
-# Rate limiting storage (in-memory, basic)
-rate_limits = defaultdict(list)
+# Shared HTTP session so flow triggers reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+SESSION.mount("http://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+# Pool connections only; never carry cookies from one trigger to the next
+SESSION.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+# Rate limiting storage (in-memory token bucket per IP)
 RATE_LIMIT_REQUESTS = 10
 RATE_LIMIT_WINDOW = 300  # 5 minutes
+RATE_LIMIT_RATE = RATE_LIMIT_REQUESTS / RATE_LIMIT_WINDOW  # tokens per second
+RATE_LIMIT_MAX_IPS = 16384  # hard cap on tracked IPs
+RATE_LIMIT_SWEEP_EVERY = 1000  # checks between idle-entry sweeps
+RATE_LIMIT_SHARDS = 16  # must be a power of two
+
+class _BucketShard:
+    """One lock-guarded slice of the rate-limit map"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()  # ip -> (tokens, last_refill), least recent first
+        self.checks = 0
+
+_shards = [_BucketShard() for _ in range(RATE_LIMIT_SHARDS)]
+_SHARD_MAX_IPS = max(1, RATE_LIMIT_MAX_IPS // RATE_LIMIT_SHARDS)
+
+# Parsed flows.yml cache: (mtime, size, flows, flows_by_id)
+_FLOWS_CACHE = None
+
+# Matches a whole-value ${VAR} reference
+_ENV_REF = re.compile(r'\$\{([^}]+)\}')
+
+@functools.lru_cache(maxsize=128)
+def _resolve_env_reference(value):
+    """Resolve a ${VAR} string; ENV is fixed after startup so results are cached"""
+    match = _ENV_REF.fullmatch(value)
+    if match:
+        return os.getenv(match.group(1), value)  # Return original if env var not found
+    return value
 
 def resolve_env_variables(value):
     """Resolve environment variable references in YAML values"""
-    if isinstance(value, str) and value.startswith('${') and value.endswith('}'):
-        env_var = value[2:-1]  # Remove ${ and }
-        return os.getenv(env_var, value)  # Return original if env var not found
+    if isinstance(value, str):
+        return _resolve_env_reference(value)
     return value
 
-def load_flows():
-    """Load flows from YAML, ENV, or legacy fallback"""
-    flows = []
+def read_flows_yaml(yaml_path):
+    """Read raw flows.yml data, using a JSON sidecar cache when it is fresh"""
+    cache_path = yaml_path.with_name(yaml_path.name + ".cache.json")
+    raw = yaml_path.read_bytes()
+    digest = hashlib.sha256(raw).hexdigest()
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        # Only trust a sidecar written for this exact flows.yml
+        if isinstance(cached, dict) and cached.get('yaml_sha256') == digest:
+            return cached['data']
+    except (OSError, ValueError, KeyError):
+        pass  # Missing or unreadable cache, parse YAML instead
     
-    # Try YAML first
-    yaml_path = Path("flows.yml")
-    if yaml_path.exists():
-        try:
-            with open(yaml_path, 'r', encoding='utf-8') as f:
-                data = yaml.safe_load(f)
-                yaml_flows = data.get('flows', [])
-                
-                # Resolve environment variables in YAML flows
-                for flow in yaml_flows:
-                    flow['flow_url'] = resolve_env_variables(flow.get('flow_url', ''))
-                    flow['launch_key'] = resolve_env_variables(flow.get('launch_key', ''))
-                    
-                return yaml_flows
-        except Exception as e:
-            print(f"Error loading YAML: {e}")
+    # Imported lazily so ENV-only deployments never load PyYAML
+    import yaml
+    # Use the libyaml C loader when available
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    data = yaml.load(raw.decode('utf-8'), Loader=loader)
+    
+    # Store unresolved data only, so secrets from ENV never hit the disk
+    tmp_path = None
+    try:
+        # Unique temp file per writer so concurrent workers don't clobber each other
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, prefix=cache_path.name, suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'yaml_sha256': digest, 'data': data}, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except (OSError, TypeError, ValueError) as e:
+        print(f"Could not write flows cache: {e}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    
+    return data
+
+def _build_env_flows():
+    """Build flows from ENV groups or legacy fallback"""
+    flows = []
     
     # Try ENV groups (FLOW_1_*, FLOW_2_*, etc.)
     flow_groups = {}
@@ -88,52 +149,202 @@ def load_flows():
     
     return []
 
+def _index_flows(flows):
+    """Build an id -> flow index, first match wins on duplicate ids"""
+    index = {}
+    for f in flows:
+        index.setdefault(f['id'], f)
+    return index
+
+_ENV_FLOWS = _build_env_flows()
+_ENV_FLOWS_BY_ID = _index_flows(_ENV_FLOWS)
+
+def _load_flows_indexed():
+    """Load flows from YAML, ENV, or legacy fallback, with their id index"""
+    global _FLOWS_CACHE
+    
+    # Try YAML first
+    yaml_path = Path("flows.yml")
+    try:
+        st = os.stat(yaml_path)
+    except OSError:
+        st = None
+    
+    if st:
+        # Reuse parsed flows while the file is unchanged
+        cache = _FLOWS_CACHE
+        if cache and cache[:2] == (st.st_mtime, st.st_size):
+            return cache[2], cache[3]
+        
+        try:
+            data = read_flows_yaml(yaml_path)
+            yaml_flows = data.get('flows', [])
+            
+            # Resolve environment variables in YAML flows
+            for flow in yaml_flows:
+                flow['flow_url'] = resolve_env_variables(flow.get('flow_url', ''))
+                flow['launch_key'] = resolve_env_variables(flow.get('launch_key', ''))
+            
+            # Flows and index are swapped in together in one assignment
+            index = _index_flows(yaml_flows)
+            _FLOWS_CACHE = (st.st_mtime, st.st_size, yaml_flows, index)
+            return yaml_flows, index
+        except Exception as e:
+            print(f"Error loading YAML: {e}")
+    
+    # ENV groups and legacy fallback are resolved once at import
+    return _ENV_FLOWS, _ENV_FLOWS_BY_ID
+
+def load_flows():
+    """Load flows from YAML, ENV, or legacy fallback"""
+    return _load_flows_indexed()[0]
+
+def get_flow(flow_id):
+    """Look up a single flow by id"""
+    return _load_flows_indexed()[1].get(flow_id)
+
 def get_client_ip():
     """Get client IP for rate limiting"""
     return request.headers.get('X-Forwarded-For', request.remote_addr)
 
+def sweep_rate_limits(buckets, now):
+    """Drop buckets idle for a full window (they would be full again anyway)"""
+    while buckets:
+        ip, (_, last) = next(iter(buckets.items()))
+        if now - last < RATE_LIMIT_WINDOW:
+            break
+        del buckets[ip]
+
 def check_rate_limit(ip):
-    """Simple in-memory rate limiting"""
-    now = time.time()
-    # Clean old entries
-    rate_limits[ip] = [req_time for req_time in rate_limits[ip] 
-                      if now - req_time < RATE_LIMIT_WINDOW]
+    """Simple in-memory token bucket rate limiting"""
+    shard = _shards[hash(ip) & (RATE_LIMIT_SHARDS - 1)]
     
-    if len(rate_limits[ip]) >= RATE_LIMIT_REQUESTS:
-        return False
-    
-    rate_limits[ip].append(now)
-    return True
+    with shard.lock:
+        # Read the clock under the lock so stored timestamps stay ordered
+        now = time.monotonic()
+        buckets = shard.buckets
+        shard.checks += 1
+        if shard.checks >= RATE_LIMIT_SWEEP_EVERY:
+            shard.checks = 0
+            sweep_rate_limits(buckets, now)
+        
+        bucket = buckets.get(ip)
+        if bucket is None:
+            tokens = RATE_LIMIT_REQUESTS  # new IP starts with a full bucket
+        else:
+            # Refill based on elapsed time, capped at the burst size
+            tokens, last = bucket
+            tokens = min(RATE_LIMIT_REQUESTS, tokens + (now - last) * RATE_LIMIT_RATE)
+        
+        allowed = tokens >= 1
+        buckets[ip] = (tokens - 1 if allowed else tokens, now)
+        buckets.move_to_end(ip)
+        # Evict the least recently seen IP once over the cap
+        if len(buckets) > _SHARD_MAX_IPS:
+            buckets.popitem(last=False)
+    return allowed
 
-def log_trigger(flow_id, flow_title, name, status, http_status=None, ip=None, user_agent=None):
-    """Log trigger attempt to CSV"""
-    csv_path = Path("logs/trigger_log.csv")
-    csv_path.parent.mkdir(parents=True, exist_ok=True)
+# Trigger log is written by a background thread in small batches
+TRIGGER_LOG_PATH = Path("logs/trigger_log.csv")
+LOG_FLUSH_ROWS = 64
+LOG_FLUSH_INTERVAL = 0.5  # seconds
+_CSV_HEADER = ("time_utc", "flow_id", "flow_title", "name",
+               "status", "http_status", "ip", "ua")
+LOG_QUEUE_MAX = 10000  # rows held while the writer catches up
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_MAX)
+_LOG_STOP = object()
+
+def _init_trigger_log():
+    """Create the CSV log with its header row if it does not exist yet"""
+    try:
+        TRIGGER_LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
+        # Append mode never truncates rows another worker has already written
+        with TRIGGER_LOG_PATH.open("a", newline="", encoding="utf-8") as f:
+            if f.tell() == 0:
+                csv.writer(f).writerow(_CSV_HEADER)
+    except OSError as e:
+        # A broken log directory should cost log rows, not the app
+        print(f"Error initialising trigger log: {e}")
+
+_init_trigger_log()
+
+def _log_writer():
+    """Drain queued rows into the CSV, flushing every N rows or T seconds"""
+    log_fh = writer = None
+    pending = 0
+    deadline = None
+    while True:
+        timeout = max(0, deadline - time.monotonic()) if pending else None
+        try:
+            row = _log_queue.get(timeout=timeout)
+        except queue.Empty:
+            row = None
+        
+        if row is _LOG_STOP:
+            break
+        try:
+            if log_fh is None:
+                log_fh = TRIGGER_LOG_PATH.open("a", newline="", encoding="utf-8")
+                writer = csv.writer(log_fh)
+            if row is not None:
+                writer.writerow(row)
+                pending += 1
+                if pending == 1:
+                    deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+            
+            if pending and (pending >= LOG_FLUSH_ROWS or time.monotonic() >= deadline):
+                log_fh.flush()
+                pending = 0
+        except (OSError, csv.Error) as e:
+            # Keep the writer alive; reopen the file on the next row after I/O errors
+            print(f"Error writing trigger log: {e}")
+            pending = 0
+            if isinstance(e, OSError) and log_fh is not None:
+                try:
+                    log_fh.close()
+                except OSError:
+                    pass
+                log_fh = None
     
+    if log_fh is not None:
+        try:
+            log_fh.close()
+        except OSError as e:
+            print(f"Error closing trigger log: {e}")
+
+_log_thread = threading.Thread(target=_log_writer, name="trigger-log-writer", daemon=True)
+_log_thread.start()
+
+@atexit.register
+def _stop_log_writer():
+    """Flush any buffered rows on interpreter shutdown"""
+    try:
+        _log_queue.put(_LOG_STOP, timeout=2)
+    except queue.Full:
+        return
+    _log_thread.join(timeout=2)
+
+def log_trigger(flow_id, flow_title, name, status, http_status=None, ip=None, user_agent=None,
+                time_utc=None):
+    """Queue a trigger attempt for the CSV log"""
     # Truncate user agent to 200 chars
-    if user_agent and len(user_agent) > 200:
-        user_agent = user_agent[:200]
+    user_agent = (user_agent or "")[:200]
     
-    row = [
-        datetime.utcnow().isoformat() + "Z",
+    row = (
+        time_utc or datetime.utcnow().isoformat(timespec="seconds") + "Z",
         flow_id,
         flow_title,
         name,
         status,
         http_status or "",
         ip or "",
-        user_agent or ""
-    ]
-    
-    file_exists = csv_path.exists()
-    with csv_path.open("a", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        if not file_exists:
-            writer.writerow([
-                "time_utc", "flow_id", "flow_title", "name", 
-                "status", "http_status", "ip", "ua"
-            ])
-        writer.writerow(row)
+        user_agent
+    )
+    
+    try:
+        _log_queue.put_nowait(row)
+    except queue.Full:
+        print(f"Trigger log queue full, dropping row for {flow_id}")
 
 @app.route("/")
 def dashboard():
@@ -144,8 +355,7 @@ def dashboard():
 @app.route("/flow/<flow_id>")
 def flow_login(flow_id):
     """Per-flow login page"""
-    flows = load_flows()
-    flow = next((f for f in flows if f['id'] == flow_id), None)
+    flow = get_flow(flow_id)
     
     if not flow:
         flash("Flow not found", "danger")
@@ -156,8 +366,8 @@ def flow_login(flow_id):
 @app.route("/trigger/<flow_id>", methods=["POST"])
 def trigger_flow(flow_id):
     """Trigger a specific flow"""
-    flows = load_flows()
-    flow = next((f for f in flows if f['id'] == flow_id), None)
+    now_iso = datetime.utcnow().isoformat(timespec="seconds") + "Z"
+    flow = get_flow(flow_id)
     
     if not flow:
         flash("Flow not found", "danger")
@@ -179,14 +389,17 @@ def trigger_flow(flow_id):
     if not name or not key:
         flash("Vennligst fyll ut begge felt", "warning")
         log_trigger(flow_id, flow['title'], name or "EMPTY", "VALIDATION_ERROR", 
-                   ip=client_ip, user_agent=user_agent)
+                   ip=client_ip, user_agent=user_agent, time_utc=now_iso)
         return redirect(url_for('flow_login', flow_id=flow_id))
     
     # Validate access code
-    if key != flow['launch_key']:
+    # Constant-time compare; bytes so non-ASCII input doesn't raise
+    launch_key = flow.get('launch_key')
+    # Non-string keys from YAML (int, None) never match, as with the old != check
+    if not isinstance(launch_key, str) or not hmac.compare_digest(key.encode("utf-8"), launch_key.encode("utf-8")):
         flash("Feil kode. Prøv igjen.", "danger")
         log_trigger(flow_id, flow['title'], name, "ACCESS_DENIED", 
-                   ip=client_ip, user_agent=user_agent)
+                   ip=client_ip, user_agent=user_agent, time_utc=now_iso)
         return redirect(url_for('flow_login', flow_id=flow_id))
     
     # Trigger flow
@@ -194,30 +407,30 @@ def trigger_flow(flow_id):
         # For GET request, send data as query parameters instead of JSON body
         params = {
             "triggered_by": name,
-            "trigger_time": datetime.utcnow().isoformat() + "Z",
+            "trigger_time": now_iso,
             "source": "flask",
             "flow_id": flow_id
         }
         
-        response = requests.get(
+        response = SESSION.get(
             flow['flow_url'], 
             params=params,  # Query parameters instead of json payload
-            timeout=20
+            timeout=(3.05, 15)  # (connect, read) so dead endpoints fail fast
         )
         
         if response.status_code in [200, 202]:
             flash(f"Flyten '{flow['title']}' ble trigget og logget!", "success")
             log_trigger(flow_id, flow['title'], name, "OK", 
-                    response.status_code, client_ip, user_agent)
+                    response.status_code, client_ip, user_agent, time_utc=now_iso)
         else:
             flash(f"Feil ved kjøring. Statuskode: {response.status_code}", "danger")
             log_trigger(flow_id, flow['title'], name, "HTTP_ERROR", 
-                    response.status_code, client_ip, user_agent)
+                    response.status_code, client_ip, user_agent, time_utc=now_iso)
             
     except Exception as e:
         flash(f"En feil oppstod: {str(e)}", "danger")
         log_trigger(flow_id, flow['title'], name, "EXCEPTION", 
-                ip=client_ip, user_agent=user_agent)
+                ip=client_ip, user_agent=user_agent, time_utc=now_iso)
     
     return redirect(url_for('flow_login', flow_id=flow_id))
 